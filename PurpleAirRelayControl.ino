@@ -13,56 +13,77 @@
 
 // delay time of the main loop (msec)
 // it will only check for switch changes after waiting this long
-int LOOP_DELAY = 1000;
+const int LOOP_DELAY = 1000;
 
 // only get data from sensors that have reported data recently, default = 60 minutes (sec)
-int MAX_SENSOR_AGE = 60*60;
+const int MAX_SENSOR_AGE = 60*60;
 
 // delay time between purple air requests to avoid API blacklist, default = 5 min (msec)
-int PURPLE_AIR_DELAY = 1000*60*5;
-long int lastPurpleAirUpdate = -1; // init negative so that we check the first time
-long int timeSinceLastPurpleAirUpdate;
+const int PURPLE_AIR_DELAY = 1000*60*5;
+bool purpleAirUpdated = false; // false until the first request so that we check the first time
+unsigned long lastPurpleAirUpdate;
+unsigned long timeSinceLastPurpleAirUpdate;
+
+// if a request fails, keep using the last good reading until it is this old, default = 30 minutes (msec)
+// after that assume the worst and disable ventilation
+const long int MAX_STALE_AQI_AGE = 1000*60*30;
+bool hasLastGoodAirQuality = false;
+int lastGoodAirQuality;
+unsigned long lastGoodAirQualityUpdate;
+
+// give up waiting for a PurpleAir response after this long so the switch stays responsive, default = 10 s (msec)
+const int HTTP_RESPONSE_TIMEOUT = 1000*10;
 
 // nuke the session after some maximum uptime to avoid max socket # issues
 // note that the resetFunc does not work with the MKR WiFi 1010 but the SleepyDog library does
 // after reset you will need to replug in the USB cable (COM port hangs)
-long int lastRestart;
-long int timeSinceLastRestart;
-long int MAX_RUN_TIME = 1000*60*60*24; // every 24 hours (in msec)
-
-// constants
-int SWITCH_STATE_OFF = 0;
-int SWITCH_STATE_PURPLEAIR = 1;
-int SWITCH_STATE_ON = 2;
-
-int PIN_RELAY1 = 1; // relay 1 control is hardwired to digital pin 1 on the relay board
-int PIN_RELAY2 = 2; // relay 2 control is hardwired to digital pin 2 on the relay board
-int PIN_SWITCH_INPUT1 = A1; // use A1 because it is a screw terminal on the relay board
-int PIN_SWITCH_INPUT2 = A2; // use A2 because it is a screw terminal on the relay board
+unsigned long lastRestart;
+unsigned long timeSinceLastRestart;
+const long int MAX_RUN_TIME = 1000*60*60*24; // every 24 hours (in msec)
 
-// define colors for the on board LED
-int COLOR_VENTILATION_ON_1 = 0;
-int COLOR_VENTILATION_ON_2 = 50;
-int COLOR_VENTILATION_ON_3 = 0;
+// reset the controller if the main loop hangs (e.g. stuck in the WiFi stack) for this long (msec)
+// 16 s is the longest timeout supported on the SAMD21, set to 0 to disable while debugging
+// any single blocking step must finish within this time, so the PurpleAir request feeds it between
+// connecting, waiting for the status (up to HTTP_RESPONSE_TIMEOUT) and reading the body
+const int WATCHDOG_TIMEOUT = 1000*16;
 
-int COLOR_VENTILATION_OFF_1 = 50;
-int COLOR_VENTILATION_OFF_2 = 0;
-int COLOR_VENTILATION_OFF_3 = 0;
+// constants
+const int SWITCH_STATE_OFF = 0;
+const int SWITCH_STATE_PURPLEAIR = 1;
+const int SWITCH_STATE_ON = 2;
+
+const int PIN_RELAY1 = 1; // relay 1 control is hardwired to digital pin 1 on the relay board
+const int PIN_RELAY2 = 2; // relay 2 control is hardwired to digital pin 2 on the relay board
+const int PIN_SWITCH_INPUT1 = A1; // use A1 because it is a screw terminal on the relay board
+const int PIN_SWITCH_INPUT2 = A2; // use A2 because it is a screw terminal on the relay board
+const int PIN_LED1 = 25; // on board RGB LED channels are wired to pins 25-27 of the NINA WiFi module
+const int PIN_LED2 = 26;
+const int PIN_LED3 = 27;
+
+// define colors for the on board LED, one value per LED pin (PIN_LED1, PIN_LED2, PIN_LED3)
+const int COLOR_VENTILATION_ON[3] = {0, 50, 0};
+const int COLOR_VENTILATION_OFF[3] = {50, 0, 0};
 
 // read secret info file for wifi connection and purple air sensor id
 // TODO: Move API key to secrets file if it is abused, otherwise keep it here to simplify new user setup
-char SSID[] = SECRET_SSID;
-char WIFI_PASSWORD[] = SECRET_PASS;
-char API_KEY[] = "1A37BB5C-E051-11EC-8561-42010A800005";
-int N_SENSORS = sizeof(SECRET_SENSOR_IDS)/sizeof(SECRET_SENSOR_IDS[0]);
+const char SSID[] = SECRET_SSID;
+const char WIFI_PASSWORD[] = SECRET_PASS;
+const char API_KEY[] = "1A37BB5C-E051-11EC-8561-42010A800005";
+const int N_SENSORS = sizeof(SECRET_SENSOR_IDS)/sizeof(SECRET_SENSOR_IDS[0]);
 
 // wifi settings
 int status = WL_IDLE_STATUS; // initially not connected to wifi
-char SERVER[] = "api.purpleair.com";
-int HTTPS_PORT = 443;
+const char SERVER[] = "api.purpleair.com";
+const int HTTPS_PORT = 443;
+// WiFiNINA defaults to no low power mode, set it explicitly so the choice is visible here
+// set to true to let the radio sleep between beacons, trading response time for lower power draw
+const bool WIFI_LOW_POWER_MODE = false;
 WiFiSSLClient WIFI;
 HttpClient client = HttpClient(WIFI, SERVER, HTTPS_PORT);
 
+// the sensor list never changes, so the request path is built once in setup
+String requestString;
+
 // allocate the memory for the json parsing document
 StaticJsonDocument<2048> doc;
 
@@ -72,6 +93,10 @@ bool ventilationState = true;
 int airQuality = DISABLE_THRESHOLD;
 int switchState = SWITCH_STATE_OFF;
 
+// last state written to the relays and LED, so we only touch the hardware when it changes
+bool relaysInitialized = false;
+bool relayState;
+
 void setup() {
   // record startup time
   lastRestart = millis();
@@ -81,9 +106,9 @@ void setup() {
 	pinMode(PIN_RELAY2, OUTPUT);
 
   // enabled LED control
-  WiFiDrv::pinMode(25, OUTPUT);
-  WiFiDrv::pinMode(26, OUTPUT);
-  WiFiDrv::pinMode(27, OUTPUT);
+  WiFiDrv::pinMode(PIN_LED1, OUTPUT);
+  WiFiDrv::pinMode(PIN_LED2, OUTPUT);
+  WiFiDrv::pinMode(PIN_LED3, OUTPUT);
   
 	// enable pullups on digital pins
 	pinMode(PIN_SWITCH_INPUT1, INPUT_PULLUP);
@@ -97,37 +122,65 @@ void setup() {
 	}
   Serial.println("WIFI STATUS: connected\n");
 
-  // reset the watchdog once after wifi is setup
-  Watchdog.reset();
+  // set the radio power mode once connected
+  if (WIFI_LOW_POWER_MODE) {
+    WiFi.lowPowerMode();
+  } else {
+    WiFi.noLowPowerMode();
+  }
+
+  // build the PurpleAir request once
+  requestString = buildRequestString();
+
+  // bound how long a PurpleAir request can block the main loop
+  client.setHttpResponseTimeout(HTTP_RESPONSE_TIMEOUT);
+
+  // start the watchdog once after wifi is setup
+  if (WATCHDOG_TIMEOUT > 0) {
+    Watchdog.enable(WATCHDOG_TIMEOUT);
+  }
 }
 
 void loop() {
+  // take one timestamp for this pass so every interval check below agrees
+  unsigned long now = millis();
+
   // provide guidance re: when the controller will restart
   // restart is handled automatically by the watchdog
-  timeSinceLastRestart = millis() - lastRestart;
+  timeSinceLastRestart = now - lastRestart;
   if (timeSinceLastRestart < MAX_RUN_TIME) {
-    Serial.println(String(timeSinceLastRestart/1000) + "s uptime < " + String(MAX_RUN_TIME/1000) + "s max");
+    Watchdog.reset();
+    // print in pieces rather than concatenating Strings, this runs every loop and would churn the heap
+    Serial.print(timeSinceLastRestart/1000);
+    Serial.print("s uptime < ");
+    Serial.print(MAX_RUN_TIME/1000);
+    Serial.println("s max");
   } else {
-    int countdownMS = Watchdog.enable(1000);
+    Watchdog.enable(1000);
     Serial.println("Resetting in 1 second");
   }
 
   // Get switch state and ping Purple Air if necessary
   switchState = getSwitchState();
   if (switchState == SWITCH_STATE_PURPLEAIR) {
-    timeSinceLastPurpleAirUpdate = millis() - lastPurpleAirUpdate; // subtract here to avoid overflow issue
+    timeSinceLastPurpleAirUpdate = now - lastPurpleAirUpdate; // subtract here to avoid overflow issue
 
-    // check purple air if our lastUpdate time is negative or we've waited long enough
-    if (lastPurpleAirUpdate < 0 || timeSinceLastPurpleAirUpdate > PURPLE_AIR_DELAY) {
-      lastPurpleAirUpdate = millis();
+    // check purple air if we have not checked yet or we've waited long enough
+    if (!purpleAirUpdated || timeSinceLastPurpleAirUpdate > PURPLE_AIR_DELAY) {
+      purpleAirUpdated = true;
+      lastPurpleAirUpdate = now;
       airQuality = getAirQuality();
     } else {
-      Serial.println("Waiting to refresh sensor data: " + String(timeSinceLastPurpleAirUpdate/1000) + "s elapsed < " + String(PURPLE_AIR_DELAY/1000) + "s required");
+      Serial.print("Waiting to refresh sensor data: ");
+      Serial.print(timeSinceLastPurpleAirUpdate/1000);
+      Serial.print("s elapsed < ");
+      Serial.print(PURPLE_AIR_DELAY/1000);
+      Serial.println("s required");
     }
   } else {
       // If we are ON or OFF, reset the last purple air update timer
       // This allows us to force a requery by toggling off/on and then back
-      lastPurpleAirUpdate = -1;
+      purpleAirUpdated = false;
   }
 
   // update ventilation state based on switch and/or AQI
@@ -138,33 +191,46 @@ void loop() {
 	delay(LOOP_DELAY);
 }
 
-int getAirQuality() {
-  double aqi = 0;
-	Serial.println("Requesting data from PurpleAir ...");
-
+String buildRequestString() {
   // Build request string from multiple sensors (e.g. 1234%2C5678%2C5555)
   String sensorIds;
   sensorIds = SECRET_SENSOR_IDS[0];
   for (int i = 1; i < N_SENSORS; i++) {
-    sensorIds += "%2C" + SECRET_SENSOR_IDS[i];
+    sensorIds += "%2C";
+    sensorIds += SECRET_SENSOR_IDS[i];
   }
 
   // Generate request string
   // Field 1 = raw PM2.5
   // Field 2 = 10 minute average PM2.5
   // We convert to AQI later
-  String requestString = "/v1/sensors?fields=pm2.5,pm2.5_10minute&show_only=" + sensorIds + "&max_age=" + MAX_SENSOR_AGE;
+  return "/v1/sensors?fields=pm2.5,pm2.5_10minute&show_only=" + sensorIds + "&max_age=" + MAX_SENSOR_AGE;
+}
+
+int getAirQuality() {
+  double aqi = 0;
+	Serial.println("Requesting data from PurpleAir ...");
   Serial.println("Request: " + requestString);
 
+  // Feed the watchdog before each slow step (connect + TLS handshake, waiting for the status, reading the body)
+  // so that together they can take longer than WATCHDOG_TIMEOUT without triggering a reset
+  Watchdog.reset();
+
   // Send request including header
   client.beginRequest();
   client.get(requestString);
   client.sendHeader("X-API-Key", API_KEY);
   client.endRequest();
+  Watchdog.reset();
     
   int statusCode = client.responseStatusCode();
+  Watchdog.reset();
   String response = client.responseBody();
 
+  // Release the socket now rather than leaving it open until the next request
+  // The NINA module only has a handful of sockets available
+  client.stop();
+
   // Print response
   Serial.println("Status:" + String(statusCode));
   Serial.println("Response:");
@@ -176,6 +242,7 @@ int getAirQuality() {
     if (error) {
       Serial.print(F("deserializeJson() failed: "));
       Serial.println(error.f_str());
+      return getFallbackAirQuality();
     }
     JsonArray data = doc["data"];    
 
@@ -183,6 +250,12 @@ int getAirQuality() {
     int n_sensors_found = data.size();
     Serial.println("Expected sensors: " + String(N_SENSORS));
     Serial.println("Actual sensors found: " + String(n_sensors_found));
+
+    // No recent data (e.g. every sensor is older than max_age) is a failed request, not clean air
+    if (n_sensors_found == 0) {
+      Serial.println("ERROR: no sensor data returned");
+      return getFallbackAirQuality();
+    }
     
     // Calculate the average PM2.5 and output the raw data to the log
     int sensorId;
@@ -201,37 +274,59 @@ int getAirQuality() {
       Serial.println();
       PM2p5 += sensorAvgReading; // Use the average reading to calculate the raw PM2.5
     }
-    PM2p5 /= N_SENSORS;
+    PM2p5 /= n_sensors_found;
     Serial.println("Average raw PM2.5 across " + String(n_sensors_found) + " sensors: " + String(PM2p5));
 
     // Convert to AQI
     aqi = calculateAQI(PM2p5);
     Serial.println("Average AQI after conversion: " + String(aqi));
     Serial.println("NOTE: THIS MAY BE DIFFERENT THAN THE PURPLE AIR MAP DUE TO AQI CONVERSION DIFFERENCES");    
+
+    // remember this reading in case the next request fails
+    hasLastGoodAirQuality = true;
+    lastGoodAirQuality = aqi;
+    lastGoodAirQualityUpdate = millis();
 	} else {
 		Serial.println("ERROR: failed to access PurpleAir");
-    aqi = 2*DISABLE_THRESHOLD;
+    aqi = getFallbackAirQuality();
 	}
 
   return aqi;
 }
 
+// AQI to use when PurpleAir could not be read
+// reuse the last good reading if it is recent enough, otherwise force ventilation off
+int getFallbackAirQuality() {
+  if (hasLastGoodAirQuality && millis() - lastGoodAirQualityUpdate < MAX_STALE_AQI_AGE) {
+    Serial.println("Using last good AQI from " + String((millis() - lastGoodAirQualityUpdate)/1000) + "s ago: " + String(lastGoodAirQuality));
+    return lastGoodAirQuality;
+  }
+  Serial.println("No recent AQI available -> assuming poor air quality");
+  return 2*DISABLE_THRESHOLD;
+}
+
 int getSwitchState() {
   // pos1 = off (inputX high)
   // pos2 = purple air (both inputs high)
   // pos3 = on (inputX high)
+
+  // read each input once so every check below sees the same sample
+  bool input1 = digitalRead(PIN_SWITCH_INPUT1);
+  bool input2 = digitalRead(PIN_SWITCH_INPUT2);
   
-  if (digitalRead(PIN_SWITCH_INPUT1) && digitalRead(PIN_SWITCH_INPUT2)) {
+  if (input1 && input2) {
     Serial.println("SWITCH STATE: purple air");
     return SWITCH_STATE_PURPLEAIR;
-  } else if (digitalRead(PIN_SWITCH_INPUT1) && ~digitalRead(PIN_SWITCH_INPUT2)) {
+  } else if (input1 && !input2) {
     Serial.println("SWITCH STATE: on");
 		return SWITCH_STATE_ON;
-	} else if (~digitalRead(PIN_SWITCH_INPUT1) && digitalRead(PIN_SWITCH_INPUT2)) {
+	} else if (!input1 && input2) {
     Serial.println("SWITCH STATE: off");
     return SWITCH_STATE_OFF;
 	} else {
 		Serial.println("ERROR: unknown switch state");
+    // fail safe, treat it as off so we never pull in outside air based on a bad reading
+    return SWITCH_STATE_OFF;
 	}
 }
 
@@ -256,55 +351,42 @@ bool getVentilationState(int switchState, bool ventilationState, int airQuality)
 
 // Calculate AQI from the raw PM2.5 data per EPA limits
 double calculateAQI(double pm2p5) {
-  const int N = 8;
-  bool trim = true;  
-  double pmValues[N] =  {0, 12, 35.4, 55.4, 150.4, 250.4, 350.4, 500.4}; // PM2.5
-  double aqiValues[N] = {0, 50, 100,  150,  200,   300,   400,   500}; // AQI
-  return (double) linearInterpolation(pmValues, aqiValues, N, (double) pm2p5, trim);  
+  // static const so the breakpoint tables live in flash instead of being rebuilt on the stack every call
+  static const int N = 8;
+  static const double pmValues[N] =  {0, 12, 35.4, 55.4, 150.4, 250.4, 350.4, 500.4}; // PM2.5
+  static const double aqiValues[N] = {0, 50, 100,  150,  200,   300,   400,   500}; // AQI
+  return linearInterpolation(pmValues, aqiValues, N, pm2p5);
 }
 
-double linearInterpolation(double xValues[], double yValues[], int numValues, double pointX, bool trim) {
-    if (trim)
-  {
-    if (pointX <= xValues[0]) return yValues[0];
-    if (pointX >= xValues[numValues - 1]) return yValues[numValues - 1];
-  }
+// Values outside of the table are clamped to the first/last entry
+double linearInterpolation(const double xValues[], const double yValues[], int numValues, double pointX) {
+  if (pointX <= xValues[0]) return yValues[0];
+  if (pointX >= xValues[numValues - 1]) return yValues[numValues - 1];
 
   auto i = 0;
-  double rst = 0;
-  if (pointX <= xValues[0])
-  {
-    i = 0;
-    auto t = (pointX - xValues[i]) / (xValues[i + 1] - xValues[i]);
-    rst = yValues[i] * (1 - t) + yValues[i + 1] * t;
-  }
-  else if (pointX >= xValues[numValues - 1])
-  {
-    auto t = (pointX - xValues[numValues - 2]) / (xValues[numValues - 1] - xValues[numValues - 2]);
-    rst = yValues[numValues - 2] * (1 - t) + yValues[numValues - 1] * t;
-  }
-  else
-  {
-    while (pointX >= xValues[i + 1]) i++;
-    auto t = (pointX - xValues[i]) / (xValues[i + 1] - xValues[i]);
-    rst = yValues[i] * (1 - t) + yValues[i + 1] * t;
-  }
-
-  return rst;
+  while (pointX >= xValues[i + 1]) i++;
+  auto t = (pointX - xValues[i]) / (xValues[i + 1] - xValues[i]);
+  return yValues[i] * (1 - t) + yValues[i + 1] * t;
 }
 
 void setRelays(bool ventilate) {
   if (ventilate) {
     Serial.println("VENTILATION STATE: on");
-    WiFiDrv::analogWrite(25, COLOR_VENTILATION_ON_1);
-    WiFiDrv::analogWrite(26, COLOR_VENTILATION_ON_2);
-    WiFiDrv::analogWrite(27, COLOR_VENTILATION_ON_3);
   } else {
-    Serial.println("VENTILATION STATE: off");    
-    WiFiDrv::analogWrite(25, COLOR_VENTILATION_OFF_1);
-    WiFiDrv::analogWrite(26, COLOR_VENTILATION_OFF_2);
-    WiFiDrv::analogWrite(27, COLOR_VENTILATION_OFF_3);
+    Serial.println("VENTILATION STATE: off");
   }
+
+  // each LED write is an SPI transaction to the NINA module, skip them all if nothing changed
+  if (relaysInitialized && ventilate == relayState) {
+    return;
+  }
+  relaysInitialized = true;
+  relayState = ventilate;
+
+  const int* color = ventilate ? COLOR_VENTILATION_ON : COLOR_VENTILATION_OFF;
+  WiFiDrv::analogWrite(PIN_LED1, color[0]);
+  WiFiDrv::analogWrite(PIN_LED2, color[1]);
+  WiFiDrv::analogWrite(PIN_LED3, color[2]);
   
 	digitalWrite(PIN_RELAY1, ventilate);
 	digitalWrite(PIN_RELAY2, ventilate);